@@ -1,17 +1,23 @@
 import argparse
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
+import stat
 import sys
-from datetime import datetime, timedelta, timezone
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from itertools import chain
+from typing import Callable
 
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-import snowflake.connector
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 # ---------------------------------------------------------------------------
 # Logging
@@ -26,8 +32,17 @@ _stream_handler = logging.StreamHandler(sys.stdout)
 _formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 _file_handler.setFormatter(_formatter)
 _stream_handler.setFormatter(_formatter)
-logger.addHandler(_file_handler)
-logger.addHandler(_stream_handler)
+
+# Log calls only enqueue the record; a background listener thread owns the
+# file/stdout handlers, so worker threads never block on log I/O.
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _file_handler, _stream_handler, respect_handler_level=True
+)
+_log_listener.start()
+# Flush anything still queued on every exit path, including sys.exit()
+atexit.register(_log_listener.stop)
 
 
 # ---------------------------------------------------------------------------
@@ -54,19 +69,41 @@ SMTP_USER     = _require_env("SMTP_USER")       # e.g. reports@yourorg.com
 SMTP_PASS     = _require_env("SMTP_PASS")       # app password
 EMAIL_FROM      = os.environ.get("EMAIL_FROM") or ""  # defaults to SMTP_USER if blank
 EMAIL_FROM_NAME = os.environ.get("EMAIL_FROM_NAME") or "Coaching Team"
+SMTP_POOL_SIZE  = int(os.environ.get("SMTP_POOL_SIZE") or "4")  # concurrent SMTP sessions
+
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR") or ""  # blank = Jinja's per-user temp dir
 
 
 # ---------------------------------------------------------------------------
 # Snowflake connection (key-pair auth)
 # ---------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def _private_key_der() -> bytes:
+    """
+    Parse the PEM key once per process and cache it as PKCS#8 DER bytes,
+    which the connector accepts as-is — reconnects skip the ASN.1/RSA decode.
+    """
+    # Imported here rather than at module level: cryptography adds noticeable
+    # import time that early-exit paths (argparse errors, --help) never need.
+    from cryptography.hazmat.primitives.serialization import (
+        Encoding,
+        NoEncryption,
+        PrivateFormat,
+        load_pem_private_key,
+    )
+
+    private_key = load_pem_private_key(SNOWFLAKE_PRIVATE_KEY_PEM.encode("utf-8"), password=None)
+    return private_key.private_bytes(Encoding.DER, PrivateFormat.PKCS8, NoEncryption())
+
+
 def get_snowflake_connection():
-    pem_bytes = SNOWFLAKE_PRIVATE_KEY_PEM.encode("utf-8")
-    private_key = load_pem_private_key(pem_bytes, password=None)
+    # Lazily imported for the same reason as cryptography above
+    import snowflake.connector
 
     connect_kwargs = dict(
         account=SNOWFLAKE_ACCOUNT,
         user=SNOWFLAKE_USER,
-        private_key=private_key,
+        private_key=_private_key_der(),
         database=SNOWFLAKE_DATABASE,
         warehouse=SNOWFLAKE_WAREHOUSE,
     )
@@ -80,22 +117,43 @@ def get_snowflake_connection():
 # SQL
 # ---------------------------------------------------------------------------
 FEEDBACK_QUERY = """
-WITH qa AS (
+WITH answers AS (
   SELECT
       s.ID                         AS submission_id,
       s.CREATED_AT::timestamp_ntz  AS created_at,
       s.FORM_ID::string            AS form_id,
-      f.value:"name"::string       AS question_name,
-      f.value:"text"::string       AS question_text,
-      f.value:"type"::string       AS question_type,
-      COALESCE(
-        f.value:"prettyFormat"::string,
-        f.value:"answer"::string,
-        CASE WHEN IS_OBJECT(f.value:"answer") THEN TO_VARCHAR(f.value:"answer") END
-      ) AS answer_value
+      f.value                      AS ans
   FROM ANALYTICS_PROD.RAW__JOTFORM_VIEW.SUBMISSIONS s,
        LATERAL FLATTEN(input => s.ANSWERS) f
 ),
+projected AS (
+  -- Each VARIANT path is extracted exactly once per answer
+  SELECT
+      submission_id,
+      created_at,
+      form_id,
+      ans:"name"::string           AS question_name,
+      ans:"text"::string           AS question_text,
+      ans:"type"::string           AS question_type,
+      ans:"prettyFormat"::string   AS pretty_format,
+      ans:"answer"                 AS answer_variant
+  FROM answers
+),
+qa AS (
+  SELECT
+      submission_id,
+      created_at,
+      form_id,
+      question_name,
+      question_text,
+      question_type,
+      COALESCE(
+        pretty_format,
+        answer_variant::string,
+        CASE WHEN IS_OBJECT(answer_variant) THEN TO_VARCHAR(answer_variant) END
+      ) AS answer_value
+  FROM projected
+),
 per_submission AS (
   SELECT
       submission_id,
@@ -146,81 +204,231 @@ final AS (
 )
 SELECT
   f.*,
-  d.coach_email
+  ROUND(AVG(f.rating) OVER (PARTITION BY f.coach_name), 1) AS avg_rating,
+  COUNT(*) OVER (PARTITION BY f.coach_name)                AS total_responses
 FROM final f
-JOIN ANALYTICS_PROD.ANALYTICS_CORE.DIM__COACHES d
-  ON LOWER(TRIM(f.coach_name)) = LOWER(TRIM(d.coach_name))
 WHERE f.consent_to_share = TRUE
   AND f.coach_name IS NOT NULL
-  AND f.week_start = DATE_TRUNC('WEEK', DATEADD('week', %(week_offset)s, CURRENT_DATE))
-  AND (%(coach_filter)s IS NULL OR LOWER(f.coach_name) = LOWER(%(coach_filter)s))
+  AND f.week_start = %(week_start)s
+  AND (%(coach_filter)s IS NULL OR LOWER(f.coach_name) = %(coach_filter)s)  -- bind is pre-lowered
 ORDER BY f.created_at DESC
 """
 
+# Small dimension table — fetched once and joined in Python rather than
+# JOINed onto (and replicated across) every feedback row.
+COACH_EMAILS_QUERY = """
+SELECT coach_name, coach_email
+FROM ANALYTICS_PROD.ANALYTICS_CORE.DIM__COACHES
+"""
 
-def fetch_feedback(conn, week_offset: int = -1, coach_filter: str | None = None) -> dict[str, dict]:
+
+def target_week_start(week_offset: int) -> date:
+    """
+    Monday (UTC) of the week `week_offset` weeks from now, i.e. a Monday
+    week start like DATE_TRUNC('WEEK', ...) with Snowflake's default settings.
+
+    Not identical to the old DATE_TRUNC('WEEK', DATEADD(..., CURRENT_DATE)):
+    "today" is taken in UTC here, whereas CURRENT_DATE used the Snowflake
+    session timezone, so the two can pick different weeks near midnight
+    on a Monday.
+
+    Computed here instead of from CURRENT_DATE in SQL so the query text and
+    binds are identical across reruns of the same week, letting Snowflake's
+    result cache answer them.
+    """
+    today = datetime.now(timezone.utc).date()
+    return today - timedelta(days=today.weekday()) + timedelta(weeks=week_offset)
+
+
+def fetch_feedback(conn, week_offset: int = -1, coach_filter: str | None = None,
+                   while_waiting: Callable[[], None] | None = None) -> dict[str, dict]:
     """
-    Returns a dict keyed by coach_name.
+    Returns a dict keyed by coach_name. coach_email is None for coaches
+    missing from DIM__COACHES.
 
     week_offset: -1 = last week (production default), 0 = current week (test mode)
     coach_filter: if set, only return rows for that coach (case-insensitive)
+    while_waiting: optional warm-up work (e.g. opening SMTP) run while the
+                   feedback query executes asynchronously in Snowflake
     """
+    coaches: dict[str, dict] = {}
+    row_count = 0
     cursor = conn.cursor()
     try:
-        logger.info(f"Executing feedback query (week_offset={week_offset}, coach={coach_filter or 'all'})…")
-        cursor.execute(FEEDBACK_QUERY, {"week_offset": week_offset, "coach_filter": coach_filter})
-        columns = [col[0].lower() for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        logger.info(f"Fetched {len(rows)} consented feedback rows.")
+        week_start = target_week_start(week_offset)
+        logger.info(f"Executing feedback query (week_start={week_start}, coach={coach_filter or 'all'})…")
+        cursor.execute_async(FEEDBACK_QUERY, {
+            "week_start": week_start,
+            # Lowercased here so the SQL only has to LOWER() the column side
+            "coach_filter": coach_filter.lower() if coach_filter else None,
+        })
+        query_id = cursor.sfqid
+
+        # Overlap independent work with the feedback query's execution time.
+        # The lookup gets its own cursor so it can't clobber the async one.
+        email_cursor = conn.cursor()
+        try:
+            email_cursor.execute(COACH_EMAILS_QUERY)
+            # Keyed the same way the old SQL JOIN matched: trimmed, case-insensitive
+            email_map = {
+                coach_name.strip().lower(): coach_email
+                for coach_name, coach_email in email_cursor
+                if coach_name
+            }
+        finally:
+            email_cursor.close()
+        if while_waiting is not None:
+            while_waiting()
+
+        # Waits for the query (raising on server-side failure) and attaches its
+        # results; cursor.description is only replaced once the first row is read.
+        cursor.get_results_from_sfqid(query_id)
+        raw_rows = iter(cursor)
+        first = next(raw_rows, None)
+        if first is not None and cursor.description is not None:
+            columns = [col[0].lower() for col in cursor.description]
+            if len(columns) != len(first):
+                raise RuntimeError(
+                    f"Feedback query metadata has {len(columns)} columns but rows have "
+                    f"{len(first)} — cursor.description does not match the result set."
+                )
+            # Lightweight immutable rows — smaller than dicts, and the template's
+            # row.<field> lookups resolve as plain attribute access. rename=True
+            # keeps an unexpected column name from breaking the type itself.
+            FeedbackRow = namedtuple("FeedbackRow", columns, rename=True)
+
+            # Single pass over the (streaming) cursor, grouping as we go.
+            for raw in chain((first,), raw_rows):
+                row = FeedbackRow._make(raw)
+                row_count += 1
+                name = row.coach_name
+                bucket = coaches.get(name)
+                if bucket is None:
+                    coaches[name] = bucket = {
+                        "coach_name": name,
+                        "coach_email": email_map.get(name.strip().lower()),
+                        "week_start": row.week_start,
+                        # Per-coach aggregates are computed by the query's window functions
+                        "avg_rating": float(row.avg_rating) if row.avg_rating is not None else None,
+                        "total_responses": row.total_responses,
+                        "rows": [],
+                    }
+                bucket["rows"].append(row)
+        logger.info(f"Fetched {row_count} consented feedback rows.")
     finally:
         cursor.close()
 
-    coaches: dict[str, dict] = {}
-    for row in rows:
-        name = row["coach_name"]
-        if name not in coaches:
-            coaches[name] = {
-                "coach_name": name,
-                "coach_email": row["coach_email"],
-                "week_start": row["week_start"],
-                "rows": [],
-            }
-        coaches[name]["rows"].append(row)
-
     return coaches
 
 
 # ---------------------------------------------------------------------------
 # Report rendering
 # ---------------------------------------------------------------------------
-def render_report(coach_data: dict) -> str:
-    env = Environment(
-        loader=FileSystemLoader("."),
-        autoescape=True,
-    )
-    template = env.get_template("report_template.html")
+def _make_bytecode_cache() -> FileSystemBytecodeCache | None:
+    """
+    The cache directory holds compiled Python that Jinja loads and executes,
+    so it must be private to the current user. Returns None (no on-disk
+    cache) if that can't be guaranteed.
+    """
+    try:
+        if not JINJA_CACHE_DIR:
+            # Jinja's default: per-user temp dir created 0700, ownership checked
+            return FileSystemBytecodeCache()
+        os.makedirs(JINJA_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(JINJA_CACHE_DIR)
+        if not stat.S_ISDIR(st.st_mode):
+            raise OSError(f"{JINJA_CACHE_DIR} is not a directory")
+        if hasattr(os, "getuid") and st.st_uid != os.getuid():
+            raise OSError(f"{JINJA_CACHE_DIR} is not owned by the current user")
+        if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise OSError(f"{JINJA_CACHE_DIR} is writable by other users")
+        return FileSystemBytecodeCache(directory=JINJA_CACHE_DIR)
+    except (OSError, RuntimeError) as exc:
+        logger.warning(f"Jinja bytecode cache disabled: {exc}")
+        return None
+
+
+# Built once at import so every coach reuses the same compiled template.
+# auto_reload=False skips the per-render mtime check on the template file,
+# and the on-disk bytecode cache spares later runs from re-parsing it.
+_BCC = _make_bytecode_cache()
+_JINJA_ENV = Environment(
+    loader=FileSystemLoader("."),
+    autoescape=True,
+    auto_reload=False,
+    cache_size=64,
+    bytecode_cache=_BCC,
+)
+_REPORT_TEMPLATE = _JINJA_ENV.get_template("report_template.html")
 
-    rows = coach_data["rows"]
-    ratings = [r["rating"] for r in rows if r.get("rating") is not None]
-    avg_rating = round(sum(ratings) / len(ratings), 1) if ratings else None
 
-    return template.render(
+def render_report(coach_data: dict, week_label: str, generated_at: str) -> str:
+    """
+    week_label / generated_at are formatted once per run by the caller —
+    every coach in a batch shares the same week and generation time.
+    """
+    return _REPORT_TEMPLATE.render(
         coach_name=coach_data["coach_name"],
-        week_start=coach_data["week_start"].strftime("%B %d, %Y")
-            if hasattr(coach_data["week_start"], "strftime")
-            else str(coach_data["week_start"]),
-        total_responses=len(rows),
-        avg_rating=avg_rating,
+        week_start=week_label,
+        total_responses=coach_data["total_responses"],
+        avg_rating=coach_data["avg_rating"],
         max_rating=5,
-        feedback_rows=rows,
-        generated_at=datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC"),
+        feedback_rows=coach_data["rows"],
+        generated_at=generated_at,
     )
 
 
 # ---------------------------------------------------------------------------
 # Email sending
 # ---------------------------------------------------------------------------
-def send_email(to_email: str, to_name: str, subject: str, html_body: str):
+# Plain-text fallback (strip tags crudely — coaches will see HTML anyway)
+_PLAIN_TEXT = "Please view this email in an HTML-capable client to see your feedback report."
+
+
+def open_smtp_connection() -> smtplib.SMTP:
+    """Open an SMTP session and run EHLO/STARTTLS/LOGIN once so it can be reused."""
+    smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    try:
+        smtp.ehlo()
+        smtp.starttls()
+        smtp.ehlo()
+        smtp.login(SMTP_USER, SMTP_PASS)
+    except Exception:
+        smtp.close()
+        raise
+    return smtp
+
+
+def close_smtp_connection(smtp: smtplib.SMTP):
+    try:
+        smtp.quit()
+    except smtplib.SMTPException:
+        smtp.close()
+
+
+def drain_smtp_pool(smtp_pool: queue.Queue):
+    """Close every open session left in the pool."""
+    while not smtp_pool.empty():
+        smtp = smtp_pool.get_nowait()
+        if smtp is not None:
+            close_smtp_connection(smtp)
+
+
+def ensure_smtp_connection(smtp: smtplib.SMTP | None) -> smtplib.SMTP:
+    """Health-check an existing session with NOOP, reconnecting if the server dropped it."""
+    if smtp is not None:
+        try:
+            if smtp.noop()[0] == 250:
+                return smtp
+        except smtplib.SMTPServerDisconnected:
+            pass
+        logger.info("SMTP connection lost — reconnecting…")
+        close_smtp_connection(smtp)
+    return open_smtp_connection()
+
+
+def send_email(to_email: str, to_name: str, subject: str, html_body: str,
+               smtp: smtplib.SMTP | None = None):
     from_addr = EMAIL_FROM or SMTP_USER
     display_from = f"{EMAIL_FROM_NAME} <{from_addr}>"
 
@@ -229,21 +437,56 @@ def send_email(to_email: str, to_name: str, subject: str, html_body: str):
     msg["From"]    = display_from
     msg["To"]      = f"{to_name} <{to_email}>"
 
-    # Plain-text fallback (strip tags crudely — coaches will see HTML anyway)
-    plain = "Please view this email in an HTML-capable client to see your feedback report."
-    msg.attach(MIMEText(plain, "plain", "utf-8"))
+    # A fresh part per message: flattening mutates parts (e.g. their policy),
+    # so a shared part would race across the sender threads.
+    msg.attach(MIMEText(_PLAIN_TEXT, "plain", "utf-8"))
     msg.attach(MIMEText(html_body, "html", "utf-8"))
 
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-        smtp.ehlo()
-        smtp.starttls()
-        smtp.ehlo()
-        smtp.login(SMTP_USER, SMTP_PASS)
+    if smtp is None:
+        # One-off send: open (and close) a dedicated session
+        smtp = open_smtp_connection()
+        try:
+            smtp.send_message(msg)
+        finally:
+            close_smtp_connection(smtp)
+    else:
         smtp.send_message(msg)
 
     logger.info(f"Email sent to {to_email}")
 
 
+# ---------------------------------------------------------------------------
+# Per-coach processing
+# ---------------------------------------------------------------------------
+def send_coach_report(coach_name: str, coach_data: dict, subject: str, week_label: str,
+                      generated_at: str, test_to: str | None, smtp_pool: queue.Queue):
+    """
+    Render and send one coach's report. Runs on a worker thread.
+
+    subject / week_label / generated_at: shared by every coach in the run
+    test_to: if set, redirect the email to this address instead of the coach
+    smtp_pool: queue of SMTP sessions (or None placeholders, opened on first use)
+    """
+    html = render_report(coach_data, week_label, generated_at)
+
+    # In test mode, redirect to the override address
+    to_email = test_to or coach_data["coach_email"]
+    to_name  = coach_name  # always use the coach's name as display name
+
+    smtp = smtp_pool.get()
+    try:
+        smtp = ensure_smtp_connection(smtp)
+        send_email(
+            to_email=to_email,
+            to_name=to_name,
+            subject=subject,
+            html_body=html,
+            smtp=smtp,
+        )
+    finally:
+        smtp_pool.put(smtp)
+
+
 # ---------------------------------------------------------------------------
 # Entrypoint
 # ---------------------------------------------------------------------------
@@ -289,41 +532,85 @@ if __name__ == "__main__":
         week_offset = -1         # last week (production default)
         coach_filter = None
 
+    # Pool of SMTP sessions shared by the worker threads. The first session is
+    # opened while Snowflake runs the feedback query; the rest are added as
+    # None placeholders and connected lazily, so we never open more than we use.
+    smtp_pool: queue.Queue = queue.Queue()
+
+    def warm_up_smtp():
+        try:
+            smtp_pool.put(open_smtp_connection())
+        except Exception as exc:
+            logger.warning(f"SMTP warm-up failed ({exc}); will connect on first send instead.")
+
     conn = get_snowflake_connection()
     try:
-        coaches = fetch_feedback(conn, week_offset=week_offset, coach_filter=coach_filter)
+        coaches = fetch_feedback(conn, week_offset=week_offset, coach_filter=coach_filter,
+                                 while_waiting=warm_up_smtp)
+    except Exception:
+        drain_smtp_pool(smtp_pool)
+        raise
     finally:
         conn.close()
 
     if not coaches:
         period = "this week" if args.test else "last week"
         logger.info(f"No consented feedback found for {period}{' for coach: ' + args.coach if args.test else ''}. No emails sent.")
+        drain_smtp_pool(smtp_pool)
         sys.exit(0)
 
-    errors = []
-    for coach_name, coach_data in coaches.items():
-        try:
-            html = render_report(coach_data)
-            week_label = coach_data["week_start"].strftime("%b %d, %Y") \
-                if hasattr(coach_data["week_start"], "strftime") \
-                else str(coach_data["week_start"])
-            subject = f"Your Weekly Member Feedback Summary — Week of {week_label}"
-            if args.test:
-                subject = f"[TEST] {subject}"
-
-            # In test mode, redirect to the override address
-            to_email = args.to if args.test else coach_data["coach_email"]
-            to_name  = coach_name  # always use the coach's name as display name
-
-            send_email(
-                to_email=to_email,
-                to_name=to_name,
-                subject=subject,
-                html_body=html,
+    if not args.test:
+        # Test mode redirects to --to, so a missing coach email only matters here
+        missing_email = [name for name, data in coaches.items() if not data["coach_email"]]
+        for name in missing_email:
+            logger.warning(
+                f"No email found in DIM__COACHES for coach '{name}' — "
+                f"skipping their {coaches[name]['total_responses']} feedback row(s)."
             )
-        except Exception as exc:
-            logger.error(f"Failed to process/send report for {coach_name}: {exc}", exc_info=True)
-            errors.append(coach_name)
+            del coaches[name]
+        if not coaches:
+            logger.info("No coaches with a known email address. No emails sent.")
+            drain_smtp_pool(smtp_pool)
+            sys.exit(0)
+
+    # Every coach in a run shares the same week, so format the labels (and
+    # the generation timestamp) once rather than per report.
+    week_start = next(iter(coaches.values()))["week_start"]
+    if hasattr(week_start, "strftime"):
+        week_label = week_start.strftime("%B %d, %Y")
+        subject_week_label = week_start.strftime("%b %d, %Y")
+    else:
+        week_label = subject_week_label = str(week_start)
+    generated_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+
+    subject = f"Your Weekly Member Feedback Summary — Week of {subject_week_label}"
+    if args.test:
+        subject = f"[TEST] {subject}"
+
+    pool_size = max(1, min(SMTP_POOL_SIZE, len(coaches)))
+    for _ in range(pool_size - smtp_pool.qsize()):
+        smtp_pool.put(None)
+
+    test_to = args.to if args.test else None
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            futures = {
+                executor.submit(
+                    send_coach_report, coach_name, coach_data, subject,
+                    week_label, generated_at, test_to, smtp_pool,
+                ): coach_name
+                for coach_name, coach_data in coaches.items()
+            }
+            for future in as_completed(futures):
+                coach_name = futures[future]
+                try:
+                    future.result()
+                except Exception as exc:
+                    logger.error(f"Failed to process/send report for {coach_name}: {exc}", exc_info=True)
+                    errors.append(coach_name)
+    finally:
+        drain_smtp_pool(smtp_pool)
 
     if errors:
         logger.error(f"Finished with errors for coaches: {errors}")